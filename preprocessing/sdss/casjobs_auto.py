@@ -2,6 +2,8 @@ import time
 from datetime import datetime
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from SciServer.Authentication import login
 import SciServer.CasJobs as cj
@@ -28,6 +30,14 @@ class CasjobsDownloader:
             self.token = login(uname, passwd)
         self.uname = uname
         self.passwd = passwd
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4,
+                              pool_maxsize=16,
+                              max_retries=Retry(total=3,
+                                                backoff_factor=1,
+                                                status_forcelist=[502, 503, 504]))
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
 
     def download_query(self, query, table_name, save_to='data', context='MyDB'):
         """Perform a query based on the context given"""
@@ -45,21 +55,20 @@ class CasjobsDownloader:
     def download_csv(self, table_name):
         """Download the save the CSV to scidrive and download it."""
         self._create_container()
-        casjobs_session = requests.Session()
-        res = casjobs_session.post('https://apps.sciserver.org/login-portal/Account/Login',
-                                   data={
-                                       'callbackUrl': 'http://skyserver.sdss.org/CasJobs/login.aspx?nexturl=MyDB.aspx',
-                                       'username': self.uname,
-                                       'password': self.passwd
-                                   })
+        res = self.session.post('https://apps.sciserver.org/login-portal/Account/Login',
+                                data={
+                                    'callbackUrl': 'http://skyserver.sdss.org/CasJobs/login.aspx?nexturl=MyDB.aspx',
+                                    'username': self.uname,
+                                    'password': self.passwd
+                                })
         assert res.status_code == 200
         REQUEST_DATA['customQuery'] = 'SELECT * FROM {0}'.format(table_name)
         REQUEST_DATA['scidrivePath'] = '/casjobs_container'
         HEADERS['Referer'] = TABLE_DOWNLOAD_URL.format(table_name, 'TABLE', 'MyDB', 'normal')
-        res = casjobs_session.post(TABLE_DOWNLOAD_URL.format(table_name, 'TABLE', 'MyDB', 'normal'),
-                                   data=REQUEST_DATA,
-                                   headers=HEADERS,
-                                   allow_redirects=True)
+        res = self.session.post(TABLE_DOWNLOAD_URL.format(table_name, 'TABLE', 'MyDB', 'normal'),
+                                data=REQUEST_DATA,
+                                headers=HEADERS,
+                                allow_redirects=True)
         assert res.status_code == 200, 'Failed to perform query {}'.format(res.text)
 
     def _create_container(self):
@@ -71,10 +80,16 @@ class CasjobsDownloader:
             pass
         time.sleep(3)
 
-    def _download_from_scidrive(self, table_name, save_to, max_tries=20, verbose=True):
-        """Check if the table is ready to download and download it once ready"""
+    def _download_from_scidrive(self, table_name, save_to, max_tries=20, verbose=True,
+                                initial_delay=1, max_delay=30):
+        """Check if the table is ready to download and download it once ready
+
+        The container is polled with an exponential backoff, starting at `initial_delay`
+        seconds and doubling up to `max_delay` seconds between tries.
+        """
         tgt_file_path = CASJOBS_CONTAINER + '/' + table_name + '_{}'.format(self.uname) + '.csv'
         count = 0
+        delay = initial_delay
         while True:
             list_of_files = sd.directoryList(CASJOBS_CONTAINER)['contents']
             for file in list_of_files:
@@ -88,7 +103,8 @@ class CasjobsDownloader:
                 break
             if verbose:
                 print('Waiting')
-            time.sleep(10)
+            time.sleep(delay)
+            delay = min(delay * 2, max_delay)
         print('could not download file')
 
 
@@ -1,17 +1,420 @@
 import pickle
 import os
+import copy
+import hashlib
+import io
+import json
+import multiprocessing as mp
+import queue
+import sqlite3
+import threading
+import time
+import itertools
+import uuid
+from collections.abc import Set
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
 
 from dataclasses import dataclass
 
 import numpy as np
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 from logger_factory import LoggerFactory
 
+# Arrays are saved separately in .npy/.npz files, so the pickle only holds small python objects
+PICKLE_PROTOCOL = 4
+
+# Compact the metadata log once it has this many lines per live object file
+LOG_COMPACTION_RATIO = 10
+
+# Minimum number of objects per shard, when splitting a save across multiple files
+MIN_SHARD_SIZE = 64
+
+# Buffer size for writing object files, so serialization is flushed to disk in large chunks
+WRITE_BUFFER_SIZE = 4 * 1024 * 1024
+
+# zstd compression level for checkpoint files (when compression='zstd')
+ZSTD_LEVEL = 3
+
+# Maximum number of buffers for a single os.writev call (sysconf returns -1 if indeterminate)
+IOV_MAX = os.sysconf('SC_IOV_MAX') if hasattr(os, 'sysconf') and 'SC_IOV_MAX' in os.sysconf_names else -1
+if IOV_MAX <= 0:
+    IOV_MAX = 1024
+
+
+def _json_default(value):
+    """Convert numpy scalars (e.g. int64 specObjIDs) to python types for json"""
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+# Sequence number for object file names created by this process
+_FILE_SEQUENCE = itertools.count()
+
+
+def _dumps(record):
+    """Return `record` as a compact json line"""
+    return json.dumps(record, separators=(',', ':'), default=_json_default) + '\n'
+
+
+def _generation_record():
+    """Return the first line of a new metadata log file, unique to that file
+
+    Inode numbers are reused once a compacted log replaces the old one, so readers
+    compare this line instead to tell whether the log was replaced since their last read.
+    """
+    return _dumps({'generation': uuid.uuid4().hex}).encode('utf-8')
+
+
+def _fold_log(log_file, object_files, content_hashes):
+    """Fold the complete lines of a binary metadata log file into the given dicts
+
+    Returns
+    -------
+    tuple of (int, int)
+        The number of lines and bytes read
+    """
+    log_lines = 0
+    log_bytes = 0
+    for line in log_file:
+        if not line.endswith(b'\n'):
+            # Partially written by a concurrent save, read it on the next refresh
+            break
+        log_bytes += len(line)
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        if 'keys' not in record:
+            # The generation record
+            continue
+        hashes = record.get('hashes') or [None] * len(record['keys'])
+        for key, content_hash in zip(record['keys'], hashes):
+            object_files[key] = record['file']
+            content_hashes[key] = content_hash
+        log_lines += 1
+    return log_lines, log_bytes
+
+
+# Lock files held by the current thread, so that `_locked` is reentrant
+_held_locks = threading.local()
+
+
+@contextmanager
+def _locked(lock_file, shared=False):
+    """Hold a lock on `lock_file` between processes (where fcntl is available)
+
+    The lock is exclusive, unless `shared`, in which case it is only shared with
+    other shared holders.
+    """
+    held = _held_locks.__dict__.setdefault('files', set())
+    if fcntl is None or lock_file in held:
+        yield
+        return
+    with open(lock_file, 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        held.add(lock_file)
+        try:
+            yield
+        finally:
+            held.discard(lock_file)
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _sql_key(key):
+    """Convert numpy scalar keys to python types for sqlite"""
+    return key.item() if isinstance(key, np.generic) else key
+
+
+class KeySet(Set):
+    """A read-only set of object keys, backed by the sqlite keys database of a checkpoint
+
+    Membership checks are indexed lookups in the database, so the keys are never
+    loaded in memory all at once. The connection is closed by `close`, or on exit
+    when used as a context manager.
+
+    Parameters
+    ----------
+    db_file : str or os.path like
+        The sqlite database file (see `KeySet.add_keys`)
+    """
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self._conn = KeySet.connect(db_file)
+
+    @staticmethod
+    def connect(db_file, synchronous=True):
+        """Return a connection to the keys database, creating its table if needed
+
+        Without `synchronous`, commits are not synced to disk (synchronous=NORMAL), but
+        the rollback journal still is, so a crash can not corrupt the database.
+        """
+        conn = sqlite3.connect(db_file, timeout=60)
+        conn.execute('PRAGMA synchronous={}'.format('FULL' if synchronous else 'NORMAL'))
+        # No column type, so that keys keep their python type (int or str)
+        conn.execute('CREATE TABLE IF NOT EXISTS keys (k PRIMARY KEY)')
+        return conn
+
+    @staticmethod
+    def add_keys(db_file, keys, synchronous=True):
+        """Add `keys` to the database in a single transaction, ignoring duplicates"""
+        conn = KeySet.connect(db_file, synchronous=synchronous)
+        try:
+            with conn:
+                conn.executemany('INSERT OR IGNORE INTO keys (k) VALUES (?)',
+                                 ((_sql_key(key), ) for key in keys))
+        finally:
+            conn.close()
+
+    def __contains__(self, key):
+        try:
+            return self._conn.execute('SELECT 1 FROM keys WHERE k = ?', (_sql_key(key), )).fetchone() is not None
+        except sqlite3.InterfaceError:
+            # Unsupported type, can not be a saved key
+            return False
+
+    def __iter__(self):
+        return (row[0] for row in self._conn.execute('SELECT k FROM keys'))
+
+    def __len__(self):
+        return self._conn.execute('SELECT COUNT(*) FROM keys').fetchone()[0]
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _release_page_cache(filename):
+    """Drop the pages of `filename` from the page cache
+
+    Only the pages already written back to disk are dropped.
+    """
+    try:
+        fd = os.open(filename, os.O_RDONLY)
+    except FileNotFoundError:
+        # The checkpoint was removed in the meantime
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+# Single worker releasing written files from the page cache, created once per process
+# (a forked preprocessing worker does not inherit the thread of its parent's executor)
+_page_cache_executor = None
+_page_cache_pid = None
+_page_cache_lock = threading.Lock()
+
+
+def _release_page_cache_later(filename):
+    """Release `filename` from the page cache in the background (see `_release_page_cache`)"""
+    global _page_cache_executor, _page_cache_pid
+    # The shards of a save are written (and released) from several threads at once
+    with _page_cache_lock:
+        if _page_cache_pid != os.getpid():
+            _page_cache_executor = ThreadPoolExecutor(max_workers=1)
+            _page_cache_pid = os.getpid()
+        executor = _page_cache_executor
+    executor.submit(_release_page_cache, filename)
+
+
+def _fsync(filename):
+    """Sync `filename` (a file or a directory) to disk, if it still exists"""
+    try:
+        fd = os.open(filename, os.O_RDONLY)
+    except FileNotFoundError:
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _check_compression(compression):
+    """Raise an error if `compression` is not supported"""
+    if compression not in (None, 'zstd'):
+        raise ValueError(f'Unsupported compression {compression}, expected None or zstd')
+    if compression == 'zstd' and zstandard is None:
+        raise ImportError('zstd compression requires the zstandard package')
+
+
+def _write_file(filename, write_fn, compression=None, sync=False):
+    """Write a file with `write_fn(file)` through a large buffer
+
+    If `compression` is 'zstd', the file is compressed through a multi-threaded zstd
+    stream and saved as `filename.zst`.
+
+    If `sync`, the file is synced to disk before returning. Checkpoint files are not
+    read back while preprocessing, so once written they are dropped from the page
+    cache in a background thread (where supported).
+
+    Returns
+    -------
+    str
+        The name of the written file
+    """
+    if compression == 'zstd':
+        filename = filename + '.zst'
+    with open(filename, 'wb', buffering=WRITE_BUFFER_SIZE) as out_file:
+        if compression == 'zstd':
+            zst_file = zstandard.ZstdCompressor(level=ZSTD_LEVEL, threads=-1).stream_writer(out_file)
+            write_fn(zst_file)
+            zst_file.flush(zstandard.FLUSH_FRAME)
+        else:
+            write_fn(out_file)
+        if sync:
+            out_file.flush()
+            getattr(os, 'fdatasync', os.fsync)(out_file.fileno())
+    if hasattr(os, 'posix_fadvise'):
+        _release_page_cache_later(filename)
+    return filename
+
+
+def _object_file_exists(filename):
+    """Return True if `filename` exists, either as is or zstd compressed"""
+    return os.path.exists(filename) or os.path.exists(filename + '.zst')
+
+
+def _read_file(filename):
+    """Return a readable binary file for `filename`, decompressing `filename.zst` if needed"""
+    if os.path.exists(filename):
+        file = open(filename, 'rb')
+        if hasattr(os, 'posix_fadvise'):
+            # The whole file is read, so let the kernel read ahead all of it
+            os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+        return file
+    _check_compression('zstd')
+    buffer = io.BytesIO()
+    with open(filename + '.zst', 'rb') as zst_file:
+        zstandard.ZstdDecompressor().copy_stream(zst_file, buffer)
+    buffer.seek(0)
+    return buffer
+
+
+def _savez(out_file, arrays):
+    """Save `arrays` as a npz file to `out_file`"""
+    if isinstance(out_file, io.BufferedWriter):
+        np.savez(out_file, **arrays)
+    else:
+        # zipfile needs the offsets in the output, which a compressed stream can't tell
+        buffer = io.BytesIO()
+        np.savez(buffer, **arrays)
+        out_file.write(buffer.getbuffer())
+
+
+def _gather_write(out_file, buffers):
+    """Write all `buffers` to `out_file`, batching up to `IOV_MAX` of them per os.writev call"""
+    if not hasattr(os, 'writev') or not isinstance(out_file, io.BufferedWriter):
+        for buffer in buffers:
+            out_file.write(buffer)
+        return
+    out_file.flush()
+    fd = out_file.fileno()
+    views = [memoryview(buffer) for buffer in buffers]
+    start = 0
+    while start < len(views):
+        written = os.writev(fd, views[start:start + IOV_MAX])
+        while start < len(views) and written >= len(views[start]):
+            written -= len(views[start])
+            start += 1
+        if written:
+            views[start] = views[start][written:]
+
+
+def _write_stacked_arrays(out_file, arrays):
+    """Write same shape/dtype `arrays` as a single stacked .npy file without copying them
+
+    The npy header is followed by the raw bytes of every array, handed to the kernel
+    with vectored writes instead of stacking the arrays in memory first.
+    """
+    header = io.BytesIO()
+    np.lib.format.write_array_header_2_0(header, {
+        'descr': np.lib.format.dtype_to_descr(arrays[0].dtype),
+        'fortran_order': False,
+        'shape': (len(arrays),) + arrays[0].shape
+    })
+    _gather_write(out_file,
+                  [header.getvalue()] +
+                  [np.ascontiguousarray(array).reshape(-1).view(np.uint8) for array in arrays])
+
+
+def _can_stack(arrays):
+    """Return True if `arrays` share their shape and a (non-object) dtype"""
+    first = arrays[0]
+    return not first.dtype.hasobject and \
+        all(array.shape == first.shape and array.dtype == first.dtype for array in arrays)
+
+
+def _content_hash(fields):
+    """Return a blake2b digest of the fields of an object (None if it has no `np_array`)
+
+    The digest covers the shape, dtype and bytes of `np_array` and the pickle of the
+    other fields, so it only matches if every field of the object is unchanged.
+    """
+    array = fields.get('np_array')
+    if array is None:
+        return None
+    array = np.ascontiguousarray(array)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f'{array.dtype.str}{array.shape}'.encode('utf-8'))
+    digest.update(array.reshape(-1).view(np.uint8))
+    digest.update(pickle.dumps(sorted((name, value) for name, value in fields.items() if name != 'np_array'),
+                               protocol=PICKLE_PROTOCOL))
+    return digest.hexdigest()
+
+
+def _run_writer(checkpoint, save_queue, result_queue):
+    """Save the objects put in `save_queue` until the `None` sentinel is received
+
+    This runs in the background writer process of a `CheckPoint`. The metadata log
+    is read once when the writer starts and the index is kept in memory afterwards.
+    The errors of failed saves and the files to sync on `flush` are put in
+    `result_queue` once the sentinel is received.
+    """
+    checkpoint.refresh()
+    errors = []
+    while True:
+        item = save_queue.get()
+        if item is None:
+            break
+        shards, content_hashes = item
+        checkpoint.content_hashes.update(content_hashes)
+        try:
+            checkpoint._save_objects(shards)
+        except Exception as e:
+            checkpoint.logger.error('Error saving objects to %s: %s', list(shards.keys()), e)
+            saved_files = set(checkpoint.object_files.values())
+            for filename in shards:
+                if filename not in saved_files:
+                    checkpoint._remove_object_file(checkpoint.checkpoint_dir, filename)
+            errors.append(f'{list(shards.keys())}: {e!r}')
+    result_queue.put((errors, checkpoint._unsynced_files))
+
 
 @dataclass
 class RedShiftCheckPointObject:
-    """Checkpoint object for saving redshift data for galaxies"""
+    """Checkpoint object for saving redshift data for galaxies
+
+    `np_array` is the swarp output for the galaxy (height x width x bands). Its dtype
+    is float64, unless the checkpoint is created with an `array_dtype` (e.g. float16).
+    """
     key: str
     np_array: np.ndarray
     redshift: float
@@ -24,7 +427,9 @@ class CheckPoint(object):
     """A generic checkpointer class
 
     This class provides a basic checkpoint support for saving sdss images.
-    The objects are saved to disk using pickle.
+    Every save writes the newly added objects to a pkl file, except for their
+    `np_array` attribute, which is saved in a `.npy` (or `.npz`) file with the same name.
+    The files are recorded in an append-only metadata log (`<guid>.jsonl`).
 
     Parameters
     ----------
@@ -36,8 +441,31 @@ class CheckPoint(object):
         Global identifier for this checkpoint
     meta_objects: dict, default=None
         a dictionary containing metaobjects' key as key and meta objects as values
+    fsync_on_save: bool, default=False
+        If True, sync the object files, the metadata log and the keys database (in that
+        order) on every save. Otherwise, use `flush` for durability
+    background_writer: bool, default=False
+        If True, start a background writer process (see `start_writer`)
+    num_shards: int, default=None
+        The maximum number of files (written concurrently) to split a save into.
+        If None, use the number of CPUs
+    array_dtype: str or np.dtype, default=None
+        If provided, floating point arrays of a wider dtype are saved as this dtype
+        (e.g. 'float16' to save a quarter of the bytes of float64). Note that values
+        outside the range of the dtype are lost
+    compression: str, default=None
+        If 'zstd', compress the object files with zstd (requires the zstandard package)
     """
-    def __init__(self, checkpoint_dir, metaclass, guid, meta_objects=None):
+    def __init__(self,
+                 checkpoint_dir,
+                 metaclass,
+                 guid,
+                 meta_objects=None,
+                 fsync_on_save=False,
+                 background_writer=False,
+                 num_shards=None,
+                 array_dtype=None,
+                 compression=None):
         self.created_at = datetime.now()
         self.checkpoint_dir = checkpoint_dir
         if not os.path.exists(self.checkpoint_dir) and not os.path.isdir(self.checkpoint_dir):
@@ -48,6 +476,520 @@ class CheckPoint(object):
                                                'DEBUG')
         self.meta_objects = self._validate_metaobjects(meta_objects)
         self.meta_keys = set(self.meta_objects.keys())
+        self.object_files = {}
+        self.content_hashes = {}
+        self.log_lines = 0
+        self.log_offset = 0
+        self._log_generation = None
+        self._unsynced_files = []
+        self.fsync_on_save = fsync_on_save
+        self.num_shards = num_shards or os.cpu_count() or 1
+        self.array_dtype = np.dtype(array_dtype) if array_dtype is not None else None
+        _check_compression(compression)
+        self.compression = compression
+        self._writer = None
+        self._writer_queue = None
+        self._writer_results = None
+        if background_writer:
+            self.start_writer()
+
+    def __getstate__(self):
+        """Pickle only the checkpoint configuration, the objects are saved in `object_files`"""
+        state = self.__dict__.copy()
+        state['meta_objects'] = {}
+        state['meta_keys'] = set()
+        state['object_files'] = {}
+        state['content_hashes'] = {}
+        state['log_lines'] = 0
+        state['log_offset'] = 0
+        state['_log_generation'] = None
+        state['_unsynced_files'] = []
+        state['_writer'] = None
+        state['_writer_queue'] = None
+        state['_writer_results'] = None
+        return state
+
+    def __setstate__(self, state):
+        """Restore the checkpoint configuration, defaulting attributes that older checkpoints lack
+
+        Checkpoints saved before the metadata log pickled their objects along with the
+        configuration. Those objects are restored in `meta_objects` and written to an
+        object file by `_migrate_legacy_objects` (see `from_checkpoint`).
+        """
+        for name, default in (('object_files', {}),
+                              ('content_hashes', {}),
+                              ('log_lines', 0),
+                              ('log_offset', 0),
+                              ('_log_generation', None),
+                              ('_unsynced_files', []),
+                              ('fsync_on_save', False),
+                              ('num_shards', os.cpu_count() or 1),
+                              ('array_dtype', None),
+                              ('compression', None),
+                              ('_writer', None),
+                              ('_writer_queue', None),
+                              ('_writer_results', None)):
+            state.setdefault(name, default)
+        state.pop('_log_inode', None)
+        self.__dict__.update(state)
+
+    def start_writer(self):
+        """Start a background process to save objects in
+
+        Once started, `save_checkpoint` hands the new objects over to the writer process
+        and returns without waiting for them to be written. Call `close` to wait for the
+        pending saves to complete, which raises an error if any of them failed.
+
+        Notes
+        -----
+            A daemonic process (e.g. a `multiprocessing.Pool` worker) can not start the writer.
+        """
+        if self._writer is not None:
+            return
+        ctx = mp.get_context('spawn')
+        self._writer_queue = ctx.Queue()
+        self._writer_results = ctx.Queue()
+        self._writer = ctx.Process(target=_run_writer,
+                                   args=(self, self._writer_queue, self._writer_results),
+                                   daemon=True)
+        self._writer.start()
+        self.logger.debug('Started background writer process (pid: %s)', self._writer.pid)
+
+    def close(self):
+        """Wait for the background writer to save pending objects and stop it
+
+        Raises
+        ------
+        RuntimeError
+            If the writer failed to save some of the objects. These objects are kept in
+            `meta_objects` but not in `object_files`, so the next save retries them
+        """
+        if self._writer is None:
+            return
+        self._writer_queue.put(None)
+        errors, unsynced_files = self._wait_for_writer()
+        self._unsynced_files.extend(unsynced_files)
+        self._writer.join()
+        self._writer_queue.close()
+        self._writer_results.close()
+        self._writer = None
+        self._writer_queue = None
+        self._writer_results = None
+        # Rebuild the index from the log, which only records the files that were written
+        self.object_files = {}
+        self.content_hashes = {}
+        self.log_lines = 0
+        self.log_offset = 0
+        self._log_generation = None
+        self.refresh()
+        self.logger.debug('Stopped background writer process')
+        if errors:
+            raise RuntimeError('The background writer failed to save objects: {}'.format('; '.join(errors)))
+
+    def _wait_for_writer(self):
+        """Return the errors and the files to sync reported by the background writer, once it
+        has saved pending objects"""
+        while True:
+            try:
+                return self._writer_results.get(timeout=1)
+            except queue.Empty:
+                if not self._writer.is_alive():
+                    try:
+                        return self._writer_results.get_nowait()
+                    except queue.Empty:
+                        return [f'writer process exited with code {self._writer.exitcode}'], []
+
+    def _coerce(self, array):
+        """Cast a wider floating point `array` to `array_dtype`, if provided"""
+        if self.array_dtype is None or array is None:
+            return array
+        array = np.asarray(array)
+        if np.issubdtype(array.dtype, np.floating) and array.dtype.itemsize > self.array_dtype.itemsize:
+            return array.astype(self.array_dtype, copy=False)
+        return array
+
+    @staticmethod
+    def _without_array(obj):
+        """Return a shallow copy of `obj` with its `np_array` removed"""
+        if getattr(obj, 'np_array', None) is None:
+            return obj
+        obj = copy.copy(obj)
+        obj.np_array = None
+        return obj
+
+    def _object_filename(self, num_objects):
+        """Return a new name (without extension) for an object file with `num_objects` objects
+
+        The name is made of the time in milliseconds, the process id, a per process
+        sequence number and the number of objects (in hex), so names sort by time and
+        never collide between the preprocessing processes.
+        """
+        return f'{self.guid}-{int(time.time() * 1000):013x}_{os.getpid():x}_{next(_FILE_SEQUENCE):x}_{num_objects:04x}'
+
+    def _shard_objects(self, objects_to_save):
+        """Split the objects into shards of at least `MIN_SHARD_SIZE` objects, keyed by hash(key)
+
+        Returns
+        -------
+        dict
+            A dict of shard filenames (without extension) to the objects in that shard
+        """
+        num_shards = max(1, min(self.num_shards, len(objects_to_save) // MIN_SHARD_SIZE))
+        filename = self._object_filename(len(objects_to_save))
+        if num_shards == 1:
+            return {filename: objects_to_save}
+        shards = {}
+        for key, obj in objects_to_save.items():
+            shards.setdefault(f'{filename}.{hash(key) % num_shards}', {})[key] = obj
+        return shards
+
+    def _save_objects(self, shards):
+        """Save the given shards of objects and add their keys to the keys file"""
+        self._save_pkl(shards)
+        self._update_objects_on_disk([key for objects in shards.values() for key in objects])
+
+    def _write_object_file(self, filename, objects):
+        """Write the objects to a pkl file and their arrays to a npy/npz file
+
+        If every object has an `np_array` of the same shape and dtype, the arrays are
+        saved stacked in a single npy file, in the order of the objects. Otherwise, they
+        are saved in a npz file, one entry per object named by its position (keys like
+        7 and '7' would share a name). The rest of the objects is pickled.
+
+        Unless `fsync_on_save`, the written files are synced by the next `flush`.
+        """
+        written_files = []
+        arrays = [getattr(obj, 'np_array', None) for obj in objects.values()]
+        if all(array is not None for array in arrays) and _can_stack(arrays):
+            written_files.append(_write_file(os.path.join(self.checkpoint_dir, filename + '.npy'),
+                                             lambda npy_file: _write_stacked_arrays(npy_file, arrays),
+                                             compression=self.compression,
+                                             sync=self.fsync_on_save))
+        elif any(array is not None for array in arrays):
+            arrays = {str(idx): obj.np_array for idx, obj in enumerate(objects.values())
+                      if getattr(obj, 'np_array', None) is not None}
+            written_files.append(_write_file(os.path.join(self.checkpoint_dir, filename + '.npz'),
+                                             lambda npz_file: _savez(npz_file, arrays),
+                                             compression=self.compression,
+                                             sync=self.fsync_on_save))
+        meta_objects = {key: self._without_array(obj) for key, obj in objects.items()}
+        written_files.append(_write_file(os.path.join(self.checkpoint_dir, filename + '.pkl'),
+                                         lambda pkl_file: pickle.dump(meta_objects, pkl_file,
+                                                                      protocol=PICKLE_PROTOCOL),
+                                         compression=self.compression,
+                                         sync=self.fsync_on_save))
+        if not self.fsync_on_save:
+            self._unsynced_files.extend(written_files)
+
+    def _save_pkl(self, shards):
+        """Write each shard to its own object files and append them to the metadata log
+
+        The shards are written concurrently by a thread pool. Pickling holds the GIL,
+        but the pickles only hold small objects, while the array writes (the bulk of
+        the bytes) and zstd compression release it.
+
+        With `fsync_on_save`, the object files (and their directory entries) are synced
+        before they are recorded in the log.
+        """
+        if len(shards) == 1:
+            for filename, objects in shards.items():
+                self._write_object_file(filename, objects)
+        else:
+            with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+                for future in [executor.submit(self._write_object_file, filename, objects)
+                               for filename, objects in shards.items()]:
+                    future.result()
+        if self.fsync_on_save:
+            _fsync(self.checkpoint_dir)
+        self._append_to_log([{'file': filename,
+                              'keys': list(objects.keys()),
+                              'hashes': [self.content_hashes.get(key) for key in objects]}
+                             for filename, objects in shards.items()])
+
+        old_files = set(self.object_files.values())
+        for filename, objects in shards.items():
+            for key in objects:
+                self.object_files[key] = filename
+        for stale_file in old_files - set(self.object_files.values()):
+            self._remove_object_file(self.checkpoint_dir, stale_file)
+
+        if self.log_lines > LOG_COMPACTION_RATIO * len(set(self.object_files.values())):
+            self._compact_log()
+
+    def _append_to_log(self, records):
+        """Append json lines for the given records to the metadata log
+
+        The append holds the checkpoint lock, so it can not go to a log file that a
+        concurrent `_compact_log` is about to replace. With `fsync_on_save`, the log is
+        synced before returning, so the keys are only added once their records are durable.
+        """
+        payload = ''.join(_dumps(record) for record in records).encode('utf-8')
+        with _locked(CheckPoint._lock_file(self.checkpoint_dir, self.guid)), \
+                open(CheckPoint._metadata_file(self.checkpoint_dir, self.guid), 'a+b') as log_file:
+            log_file.seek(0)
+            generation = log_file.readline()
+            if not generation:
+                generation = _generation_record()
+                payload = generation + payload
+            log_file.write(payload)
+            log_file.flush()
+            end = log_file.tell()
+            if self.fsync_on_save:
+                os.fsync(log_file.fileno())
+                if end == len(payload):
+                    # A new log file
+                    _fsync(self.checkpoint_dir)
+        if generation == self._log_generation and end - len(payload) == self.log_offset:
+            # Nothing else was appended since the last read, no need to read these lines back
+            self.log_offset = end
+            self.log_lines += len(records)
+        else:
+            self.refresh()
+
+    def _migrate_legacy_objects(self):
+        """Write the objects restored from a legacy checkpoint pickle to an object file
+
+        The objects are recorded in the metadata log and the keys database like any
+        other save, and the checkpoint pickle is rewritten without them, so this only
+        happens once per checkpoint.
+        """
+        with _locked(CheckPoint._lock_file(self.checkpoint_dir, self.guid)):
+            # Another process may have migrated the checkpoint in the meantime
+            self.refresh()
+            legacy_objects = {key: obj for key, obj in self.meta_objects.items() if key not in self.object_files}
+            if not legacy_objects:
+                return
+            self.content_hashes.update({key: _content_hash(vars(obj))
+                                        for key, obj in legacy_objects.items()})
+            self._save_objects(self._shard_objects(legacy_objects))
+            self._write_checkpoint_file()
+        self.logger.info('Migrated %s objects of the legacy checkpoint %s to object files',
+                         len(legacy_objects), self.guid)
+
+    def _compact_log(self):
+        """Rewrite the metadata log with a single line per live object file
+
+        The log is read and replaced while holding the checkpoint lock, so no record
+        appended by another process in the meantime is lost.
+        """
+        metadata_file = CheckPoint._metadata_file(self.checkpoint_dir, self.guid)
+        tmp_file = f'{metadata_file}.{os.getpid()}.tmp'
+        with _locked(CheckPoint._lock_file(self.checkpoint_dir, self.guid)):
+            self.refresh()
+            keys_for_file = {}
+            for key, filename in self.object_files.items():
+                keys_for_file.setdefault(filename, []).append(key)
+            generation = _generation_record()
+            with open(tmp_file, 'wb') as log_file:
+                log_file.write(generation)
+                for filename, keys in keys_for_file.items():
+                    log_file.write(_dumps({'file': filename,
+                                           'keys': keys,
+                                           'hashes': [self.content_hashes.get(key) for key in keys]}).encode('utf-8'))
+                end = log_file.tell()
+                if self.fsync_on_save:
+                    log_file.flush()
+                    os.fsync(log_file.fileno())
+            os.replace(tmp_file, metadata_file)
+            if self.fsync_on_save:
+                _fsync(self.checkpoint_dir)
+        self.log_lines = len(keys_for_file)
+        self.log_offset = end
+        self._log_generation = generation
+        self.logger.debug('Compacted the metadata log to %s lines', self.log_lines)
+
+    def refresh(self):
+        """Fold the lines appended to the metadata log since it was last read into the index
+
+        The log is parsed once and kept in memory (`object_files`, `content_hashes`),
+        only new lines are read on later calls. If the log was compacted in the
+        meantime (its generation record changed), it is read again from the start.
+        The log is read under a shared lock, so it is not replaced while being read.
+        """
+        metadata_file = CheckPoint._metadata_file(self.checkpoint_dir, self.guid)
+        if not os.path.exists(metadata_file):
+            return
+        with _locked(CheckPoint._lock_file(self.checkpoint_dir, self.guid), shared=True), \
+                open(metadata_file, 'rb') as log_file:
+            generation = log_file.readline()
+            if generation != self._log_generation or os.fstat(log_file.fileno()).st_size < self.log_offset:
+                self.object_files = {}
+                self.content_hashes = {}
+                self.log_lines = 0
+                self.log_offset = 0
+                self._log_generation = generation
+            log_file.seek(self.log_offset)
+            log_lines, log_bytes = _fold_log(log_file, self.object_files, self.content_hashes)
+        self.log_lines += log_lines
+        self.log_offset += log_bytes
+        self.meta_keys.update(self.object_files.keys())
+
+    @staticmethod
+    def _read_log(ckptdir, guid):
+        """Fold the metadata log into a dict of object keys to their (latest) files
+
+        Returns
+        -------
+        tuple of (dict, dict)
+            The key to filename dict and the key to content hash dict
+        """
+        object_files = {}
+        content_hashes = {}
+        metadata_file = CheckPoint._metadata_file(ckptdir, guid)
+        if os.path.exists(metadata_file):
+            with open(metadata_file, 'rb') as log_file:
+                _fold_log(log_file, object_files, content_hashes)
+        return object_files, content_hashes
+
+    def _load_objects(self, load_arrays=True, mmap_mode=None):
+        """Load the meta objects from the files in `object_files`"""
+        self._load_object_files(self.object_files.keys(), load_arrays=load_arrays, mmap_mode=mmap_mode)
+
+    def _load_object_files(self, keys, load_arrays=True, mmap_mode=None):
+        """Load the meta objects for `keys` into `meta_objects`
+
+        The object files are read concurrently by a thread pool. Unpickling holds the
+        GIL, but the array file reads (the bulk of the bytes) and zstd decompression
+        release it.
+        """
+        keys_for_file = {}
+        for key in keys:
+            keys_for_file.setdefault(self.object_files[key], []).append(key)
+        if len(keys_for_file) <= 1:
+            loaded = [self._load_object_file(filename, file_keys,
+                                             load_arrays=load_arrays,
+                                             mmap_mode=mmap_mode)
+                      for filename, file_keys in keys_for_file.items()]
+        else:
+            with ThreadPoolExecutor(max_workers=min(32, len(keys_for_file))) as executor:
+                loaded = [future.result() for future in
+                          [executor.submit(self._load_object_file, filename, file_keys,
+                                           load_arrays=load_arrays,
+                                           mmap_mode=mmap_mode)
+                           for filename, file_keys in keys_for_file.items()]]
+        for objects in loaded:
+            self.meta_objects.update(objects)
+
+    def _load_object_file(self, filename, keys, load_arrays=True, mmap_mode=None):
+        """Return a dict of the objects with the given keys from the object files `filename`
+
+        With `mmap_mode`, uncompressed stacked arrays are memory mapped instead of read, so
+        processes loading the same checkpoint share the page cache rather than each holding
+        a copy. Compressed and npz array files are always read into memory.
+        """
+        with _read_file(os.path.join(self.checkpoint_dir, filename + '.pkl')) as pkl_file:
+            all_objects = pickle.load(pkl_file)
+        objects = {key: all_objects[key] for key in keys}
+        stacked_file = os.path.join(self.checkpoint_dir, filename + '.npy')
+        array_file = os.path.join(self.checkpoint_dir, filename + '.npz')
+        if load_arrays and mmap_mode and os.path.exists(stacked_file):
+            stacked = np.load(stacked_file, mmap_mode=mmap_mode)
+        elif load_arrays and _object_file_exists(stacked_file):
+            with _read_file(stacked_file) as npy_file:
+                stacked = np.load(npy_file)
+        else:
+            stacked = None
+        positions = {key: idx for idx, key in enumerate(all_objects)}
+        if stacked is not None:
+            for key in keys:
+                objects[key].np_array = stacked[positions[key]]
+        elif load_arrays and _object_file_exists(array_file):
+            with _read_file(array_file) as npz_file, np.load(npz_file) as arrays:
+                for key in keys:
+                    if str(positions[key]) in arrays:
+                        objects[key].np_array = arrays[str(positions[key])]
+        return objects
+
+    def get_object(self, key, load_array=True, mmap_mode=None):
+        """Return the meta object for `key`, loading only its own file if it is not in memory
+
+        Parameters
+        ----------
+        key : str
+            The key of the meta object
+        load_array: bool, default=True
+            If False, `np_array` of the meta object is not loaded from the array file
+        mmap_mode: str, default=None
+            If set (e.g. 'r'), `np_array` is memory mapped from the array file, see `numpy.load`
+
+        Raises
+        ------
+        KeyError
+            If no object with `key` is saved in this checkpoint
+        """
+        obj = self.meta_objects.get(key)
+        if obj is None or (load_array and getattr(obj, 'np_array', None) is None):
+            obj = self._load_object_file(self.object_files[key], [key],
+                                         load_arrays=load_array,
+                                         mmap_mode=mmap_mode)[key]
+            self.meta_objects[key] = obj
+        return obj
+
+    def get_objects(self, keys, load_arrays=True, mmap_mode=None):
+        """Return a dict of the meta objects for `keys`, loading the ones not in memory
+
+        Unlike calling `get_object` for each key, the object files are read concurrently.
+
+        Parameters
+        ----------
+        keys : iterable of str
+            The keys of the meta objects
+        load_arrays: bool, default=True
+            If False, `np_array` of the meta objects is not loaded from the array files
+        mmap_mode: str, default=None
+            If set (e.g. 'r'), `np_array` is memory mapped from the array files, see `numpy.load`
+
+        Raises
+        ------
+        KeyError
+            If no object with one of `keys` is saved in this checkpoint
+        """
+        keys = list(keys)
+        missing = [key for key in keys
+                   if key not in self.meta_objects
+                   or (load_arrays and getattr(self.meta_objects[key], 'np_array', None) is None)]
+        self._load_object_files(missing, load_arrays=load_arrays, mmap_mode=mmap_mode)
+        return {key: self.meta_objects[key] for key in keys}
+
+    def _update_objects_on_disk(self, keys_to_save):
+        """Add the keys of the saved objects to the keys database in a single transaction"""
+        if not keys_to_save:
+            return
+        KeySet.add_keys(CheckPoint._keys_file(self.checkpoint_dir, self.guid),
+                        keys_to_save,
+                        synchronous=self.fsync_on_save)
+
+    def flush(self):
+        """Flush the object files written since the last flush, the checkpoint, metadata log
+        and keys files and the checkpoint directory to disk
+
+        The object files and the log are synced before the keys file.
+        """
+        unsynced_files, self._unsynced_files = self._unsynced_files, []
+        for filename in unsynced_files + [self.get_loc(),
+                                          CheckPoint._metadata_file(self.checkpoint_dir, self.guid),
+                                          self.checkpoint_dir,
+                                          CheckPoint._keys_file(self.checkpoint_dir, self.guid)]:
+            _fsync(filename)
+
+    @staticmethod
+    def _keys_file(ckptdir, guid):
+        return os.path.join(ckptdir, guid + '.sqlite')
+
+    @staticmethod
+    def _metadata_file(ckptdir, guid):
+        return os.path.join(ckptdir, guid + '.jsonl')
+
+    @staticmethod
+    def _lock_file(ckptdir, guid):
+        return os.path.join(ckptdir, guid + '.lock')
+
+    @staticmethod
+    def _remove_object_file(ckptdir, filename):
+        """Remove the object files for `filename` if they exist"""
+        for extension in ('.pkl', '.npy', '.npz', '.pkl.zst', '.npy.zst', '.npz.zst'):
+            if os.path.exists(os.path.join(ckptdir, filename + extension)):
+                os.remove(os.path.join(ckptdir, filename + extension))
 
     def _validate_metaobjects(self, meta_objects):
         """Validate `meta_objects` as instances of the metaclass"""
@@ -62,33 +1004,65 @@ class CheckPoint(object):
     def save_checkpoint(self, obj_kwargs_list=None, overwrite=True):
         """Save the checkpoint object
 
-        This function saves the checkpoint object as a pkl file in the checkpoint directory
+        This function saves the checkpoint object as a pkl file in the checkpoint directory,
+        along with a new object file for the objects added since the last save
 
         Arguments:
         ----------
         obj_kwargs : list of dict
             A list of kwargs to self.meta_class
         overwrite : bool, default=True
-            If True, this will remove the old objects if they exist in the checkpointer
+            If True, this will remove the old objects if they exist in the checkpointer.
+            Objects that are unchanged (same content hash of every field) are not saved again
         """
+        new_objects = {key: obj for key, obj in self.meta_objects.items() if key not in self.object_files}
+        content_hashes = {key: _content_hash(vars(obj)) for key, obj in new_objects.items()}
         if obj_kwargs_list is not None:
 
             for obj_kwargs in obj_kwargs_list:
-                if overwrite:
+                if 'np_array' in obj_kwargs:
+                    obj_kwargs = dict(obj_kwargs, np_array=self._coerce(obj_kwargs['np_array']))
+                content_hash = _content_hash(obj_kwargs)
+                if content_hash is not None and obj_kwargs['key'] in self.meta_keys \
+                        and self.content_hashes.get(obj_kwargs['key']) == content_hash:
+                    self.logger.debug('Key %s is unchanged in the checkpoint. Skipping', obj_kwargs['key'])
+                    continue
+                if overwrite and obj_kwargs['key'] in self.meta_keys:
                     self.meta_keys.discard(obj_kwargs['key'])
-                    exists = self.meta_objects.pop(obj_kwargs['key'], None)
-                    if exists:
-                        self.logger.debug(f'Key {obj_kwargs["key"]} already exists in the checkpoint. Overwriting')
+                    self.meta_objects.pop(obj_kwargs['key'], None)
+                    self.logger.debug('Key %s already exists in the checkpoint. Overwriting', obj_kwargs['key'])
                 if obj_kwargs['key'] not in self.meta_keys:
                     checkpoint_object = self.metaclass(**obj_kwargs)
                     self.meta_objects[obj_kwargs['key']] = checkpoint_object
+                    new_objects[obj_kwargs['key']] = checkpoint_object
+                    content_hashes[obj_kwargs['key']] = content_hash
                     self.meta_keys.add(obj_kwargs['key'])
-                    self.logger.debug(f'Added checkpoint object with key {obj_kwargs["key"]} to the checkpoint')
+                    self.logger.debug('Added checkpoint object with key %s to the checkpoint', obj_kwargs['key'])
 
-        with open(os.path.join(self.checkpoint_dir, self.guid + '.ckpt'), 'wb') as pklfile:
-            pickle.dump(self, pklfile)
-            self.logger.debug(f'Saved checkpoint with {len(self.meta_keys)} objects '
-                              f'as {os.path.join(self.checkpoint_dir, self.guid + ".ckpt")}')
+        self._write_checkpoint_file()
+        if new_objects:
+            self.content_hashes.update(content_hashes)
+            shards = self._shard_objects(new_objects)
+            if self._writer is not None:
+                self._writer_queue.put((shards, content_hashes))
+                for filename, objects in shards.items():
+                    for key in objects:
+                        self.object_files[key] = filename
+            else:
+                self._save_objects(shards)
+        self.logger.debug('Saved checkpoint with %s objects as %s',
+                          len(self.meta_keys), self.get_loc())
+
+    def _write_checkpoint_file(self):
+        """Pickle the checkpoint to a temporary file and move it in place
+
+        Other processes may be reading the checkpoint file, so it is never left
+        partially written.
+        """
+        tmp_file = f'{self.get_loc()}.{os.getpid()}.tmp'
+        with open(tmp_file, 'wb') as pklfile:
+            pickle.dump(self, pklfile, protocol=PICKLE_PROTOCOL)
+        os.replace(tmp_file, self.get_loc())
 
     def get_loc(self):
         return os.path.join(self.checkpoint_dir, self.guid + '.ckpt')
@@ -121,6 +1095,16 @@ class CheckPoint(object):
         """
         filename = os.path.join(ckptdir, guid + '.ckpt')
         if CheckPoint.checkpoint_exists(ckptdir, guid):
+            object_files, _ = CheckPoint._read_log(ckptdir, guid)
+            for object_file in set(object_files.values()):
+                CheckPoint._remove_object_file(ckptdir, object_file)
+            keys_file = CheckPoint._keys_file(ckptdir, guid)
+            for extra_file in (CheckPoint._metadata_file(ckptdir, guid),
+                               CheckPoint._lock_file(ckptdir, guid),
+                               keys_file,
+                               keys_file + '-journal'):
+                if os.path.exists(extra_file):
+                    os.remove(extra_file)
             os.remove(filename)
         else:
             if throw:
@@ -139,29 +1123,59 @@ class CheckPoint(object):
 
         Returns
         -------
-        set
+        set or KeySet
             A set of meta object keys for this checkpoint (if exists)
         """
         checkpoint = os.path.join(ckptdir, f'{guid}.ckpt')
+        keys_file = CheckPoint._keys_file(ckptdir, guid)
         if not os.path.exists(checkpoint):
             return set()
+        if not os.path.exists(keys_file) and not os.path.exists(CheckPoint._metadata_file(ckptdir, guid)):
+            # Nothing saved yet, or a legacy checkpoint with its objects in the pickle to migrate
+            CheckPoint.from_checkpoint(ckptdir, guid, load_objects=False)
+        if os.path.exists(keys_file):
+            return KeySet(keys_file)
         else:
-            ckpt = CheckPoint.from_checkpoint(ckptdir, guid)
-            return ckpt.meta_keys
+            object_files, _ = CheckPoint._read_log(ckptdir, guid)
+            return set(object_files.keys())
 
     @classmethod
-    def from_checkpoint(cls, ckptdir, guid):
-        """Return checkpoint object from the pickle file"""
+    def from_checkpoint(cls, ckptdir, guid, load_arrays=True, load_objects=True, mmap_mode=None):
+        """Return checkpoint object from the pickle file and the metadata log
+
+        The metadata log is read once into `object_files`, an index of object keys
+        to the files they are saved in, which `get_object` uses for lookups. A legacy
+        checkpoint, with its objects in the pickle, is migrated to object files first.
+
+        Parameters
+        ----------
+        ckptdir : str or os.path like
+            Checkpoint directory to look in
+        guid: str
+            GUID for the checkpoint
+        load_arrays: bool, default=True
+            If False, `np_array` of the meta objects is not loaded from the array files
+        load_objects: bool, default=True
+            If False, only the index is loaded and objects are loaded on demand by `get_object`
+        mmap_mode: str, default=None
+            If set (e.g. 'r'), `np_array` of the meta objects is memory mapped from the
+            array files, so that several processes reading the checkpoint share the pages
+        """
         assert CheckPoint.checkpoint_exists(ckptdir, guid)
         obj_pkl = os.path.join(ckptdir, guid + '.ckpt')
         with open(obj_pkl, 'rb+') as obj:
             checkpoint_obj = pickle.load(obj)
         assert isinstance(checkpoint_obj, CheckPoint), type(checkpoint_obj)
-        checkpoint_obj.logger.debug(f'Restored checkpoint with guid {checkpoint_obj.guid}, '
-                                    f'number of objects: {len(checkpoint_obj.meta_keys)}')
+        checkpoint_obj.refresh()
+        if checkpoint_obj.meta_objects:
+            checkpoint_obj._migrate_legacy_objects()
+        if load_objects:
+            checkpoint_obj._load_objects(load_arrays=load_arrays, mmap_mode=mmap_mode)
+        checkpoint_obj.logger.debug('Restored checkpoint with guid %s, number of objects: %s',
+                                    checkpoint_obj.guid, len(checkpoint_obj.meta_keys))
         return checkpoint_obj
 
     @staticmethod
     def last_modified(ckptdir, guid):
         assert CheckPoint.checkpoint_exists(ckptdir, guid)
-        return os.path.getmtime(os.path.join(ckptdir, f'{guid}.ckpt'))
\ No newline at end of file
+        return os.path.getmtime(os.path.join(ckptdir, f'{guid}.ckpt'))
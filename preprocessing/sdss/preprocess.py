@@ -3,6 +3,8 @@ from pathlib import Path
 
 import math
 
+import logging
+
 from tempfile import mkdtemp
 
 from datetime import datetime
@@ -30,7 +32,7 @@ import click
 from logger_factory import LoggerFactory
 from constants import SAS_URL, SWARP_COMMAND, CKPT_GUID
 from sdss_utils import get_guid
-from checkpoint_objects import CheckPoint, RedShiftCheckPointObject
+from checkpoint_objects import CheckPoint, KeySet, RedShiftCheckPointObject
 
 
 class PreProcess:
@@ -63,6 +65,9 @@ class PreProcess:
         storage volume pool to create checkpoints in
     overwrite_checkpoints: bool, default=False
         If True, overwrite the existing checkpoints
+    checkpoint_dtype: str, default=None
+        If provided, save the preprocessed images in the checkpoint as this dtype (e.g. float16).
+        When resuming, images saved before keep their dtype
     """
     def __init__(self,
                  images_meta,
@@ -75,7 +80,8 @@ class PreProcess:
                  num_processes=10,
                  checkpoint_dir=os.getcwd(),
                  volume_name='AstroResearch',
-                 overwrite_checkpoints=False):
+                 overwrite_checkpoints=False,
+                 checkpoint_dtype=None):
         np.random.seed(seed)
         self.logger = LoggerFactory.get_logger(self.__class__.__name__,
                                                'DEBUG',
@@ -94,6 +100,7 @@ class PreProcess:
         self.overwrite_checkpoints = overwrite_checkpoints
         self.num_processes = num_processes
         self.volume_name = volume_name
+        self.checkpoint_dtype = checkpoint_dtype
 
         if isSciServerComputeEnvironment():
             if uname is None:
@@ -111,7 +118,7 @@ class PreProcess:
 
     def _randomize_meta(self, num_samples):
         """Randomly select num_samples entry from the metadata"""
-        self.logger.debug('Sampling the data frame to {} galaxies'.format(num_samples))
+        self.logger.debug('Sampling the data frame to %s galaxies', num_samples)
         return self.images_meta.sample(frac=num_samples / self.images_meta.shape[0])
 
     def _form_process_blocks(self):
@@ -127,8 +134,8 @@ class PreProcess:
         num_blocks = math.ceil(rows / self.checkpoint_steps)
         if num_blocks == 0:
             num_blocks = 1
-        self.logger.debug('{} Galaxies with {} checkpoint steps form will form {} blocks'
-                          .format(rows, self.checkpoint_steps, num_blocks))
+        self.logger.debug('%s Galaxies with %s checkpoint steps form will form %s blocks',
+                          rows, self.checkpoint_steps, num_blocks)
         process_blocks = deque()
         for i in range(num_blocks):
             start_idx = i * self.checkpoint_steps
@@ -156,14 +163,26 @@ class PreProcess:
         if self.overwrite_checkpoints:
             shutil.rmtree(rundir / 'galaxies', ignore_errors=True)
         os.makedirs(rundir / 'galaxies', exist_ok=True)
-        self.logger.debug('Created a directory called {} to save lupton-rgb images'
-                          .format(rundir / 'galaxies'))
+        self.logger.debug('Created a directory called %s to save lupton-rgb images',
+                          rundir / 'galaxies')
         guid = CKPT_GUID
         if self.overwrite_checkpoints:
             CheckPoint.remove_ckpt(self.checkpoint_dir, guid)
         if not CheckPoint.checkpoint_exists(self.checkpoint_dir, guid):
-            checkpoint = CheckPoint(self.checkpoint_dir, RedShiftCheckPointObject, guid)
+            checkpoint = CheckPoint(self.checkpoint_dir,
+                                    RedShiftCheckPointObject,
+                                    guid,
+                                    array_dtype=self.checkpoint_dtype)
             checkpoint.save_checkpoint()
+        else:
+            # Migrate a checkpoint saved in the legacy layout once, before the workers read it
+            checkpoint = CheckPoint.from_checkpoint(self.checkpoint_dir, guid, load_objects=False)
+            if self.checkpoint_dtype is not None and checkpoint.array_dtype != np.dtype(self.checkpoint_dtype):
+                # The workers restore the dtype from the checkpoint, so update it there
+                self.logger.info('Saving new images in checkpoint %s as %s (was %s)',
+                                 guid, self.checkpoint_dtype, checkpoint.array_dtype)
+                checkpoint.array_dtype = np.dtype(self.checkpoint_dtype)
+                checkpoint.save_checkpoint()
 
         process_pool = PreProcess.get_process_pool(self.num_processes)
         manager = Manager()
@@ -183,11 +202,11 @@ class PreProcess:
         if not queue_remaining.empty():
             self.logger.debug('Saving remaining objects to the checkpoint')
             self.save_checkpoint(queue_remaining, CKPT_GUID)
-        self.logger.info(f'Process (id: {os.getpid()}) completed.')
+        self.logger.info('Process (id: %s) completed.', os.getpid())
 
     def _on_process_fail(self, exception):
         """Callback method for failed processes"""
-        self.logger.error(f'Error on process with pid {os.getpid()}, {exception}')
+        self.logger.error('Error on process with pid %s, %s', os.getpid(), exception)
 
     def _run_preprocess_for_one_block(self, ckpt_info, counter, ckpt_objs):
         """Run the preprocess pipeline for one checkpoint step"""
@@ -203,16 +222,17 @@ class PreProcess:
         redshift_objects = ckpt_objs
         objects_on_disk = CheckPoint.get_object_set(self.checkpoint_dir, guid)
         last_modified = CheckPoint.last_modified(self.checkpoint_dir, guid)
-        self.logger.debug(f'Objects on disk: {len(objects_on_disk)}, last Modified: {last_modified}')
+        self.logger.debug('Objects on disk: %s, last Modified: %s', len(objects_on_disk), last_modified)
         for i, galaxy in galaxies.iterrows():
             if CheckPoint.last_modified(self.checkpoint_dir, guid) > last_modified:
                 self.logger.debug('Loading new checkpoint, as the last checkpoint was updated.')
+                PreProcess._close_object_set(objects_on_disk)
                 objects_on_disk = CheckPoint.get_object_set(self.checkpoint_dir, guid)
                 last_modified = CheckPoint.last_modified(self.checkpoint_dir, guid)
-                self.logger.debug(f'New objects on disk: {len(objects_on_disk)}, last Modified: {last_modified}')
+                self.logger.debug('New objects on disk: %s, last Modified: %s', len(objects_on_disk), last_modified)
 
             if galaxy['specObjID'] in objects_on_disk:
-                self.logger.debug(f'Preprocessed image for galaxy with id {galaxy["specObjID"]} already saved, skipping')
+                self.logger.debug('Preprocessed image for galaxy with id %s already saved, skipping', galaxy['specObjID'])
                 continue
             download_urls = self._get_formatted_urls(galaxy['rerun'],
                                                      galaxy['run'],
@@ -227,9 +247,8 @@ class PreProcess:
                 if Path(self.fits_download_loc).joinpath(filename.replace('.bz2', '')).exists():
                     self.logger.debug('Compressed file exists, skipping download.')
                 else:
-                    self.logger.debug('Downloading compressed file {}'
-                                      ' from the sdss url to {}'.format(filename,
-                                                                        self.fits_download_loc + '/' + filename))
+                    self.logger.debug('Downloading compressed file %s from the sdss url to %s',
+                                      filename, self.fits_download_loc + '/' + filename)
                     subprocess.run('wget {0} -O {1}'.format(url,
                                                             self.fits_download_loc + '/' + filename),
                                    shell=True,
@@ -273,11 +292,11 @@ class PreProcess:
                             data_mat[:, :, 1],
                             Q=8, stretch=0.4,
                             filename=image_filename)
-            self.logger.debug('Galaxy image saved as {}'.format(image_filename))
+            self.logger.debug('Galaxy image saved as %s', image_filename)
             assert dl_count == 5, 'Downloaded only {} fits files'.format(dl_count)
 
-            self.logger.debug('Completed pre-processing for this galaxy with redshift value {} at index {}'
-                              .format(galaxy['z'], galaxy_count))
+            self.logger.debug('Completed pre-processing for this galaxy with redshift value %s at index %s',
+                              galaxy['z'], galaxy_count)
             redshift_objects.put(dict(key=galaxy['specObjID'],
                                       np_array=data_mat,
                                       redshift=galaxy['z'],
@@ -287,27 +306,35 @@ class PreProcess:
 
             galaxy_count += 1
             counter.value += 1
-            self.logger.info(f'Galaxy count: {counter.value}, steps till next checkpoint: '
-                             f'{self.checkpoint_steps - (counter.value % self.checkpoint_steps)}')
+            self.logger.info('Galaxy count: %s, steps till next checkpoint: %s',
+                             counter.value, self.checkpoint_steps - (counter.value % self.checkpoint_steps))
             dl_count = 0
             if counter.value % self.checkpoint_steps == 0:
                 self.save_checkpoint(objs=redshift_objects, guid=guid)
+        PreProcess._close_object_set(objects_on_disk)
         return redshift_objects
 
+    @staticmethod
+    def _close_object_set(objects_on_disk):
+        """Close the keys database connection of a set from `CheckPoint.get_object_set`"""
+        if isinstance(objects_on_disk, KeySet):
+            objects_on_disk.close()
+
     def save_checkpoint(self, objs, guid):
         """Update checkpoint to a new step by adding extra checkpoint objects"""
-        ckpt = CheckPoint.from_checkpoint(self.checkpoint_dir, guid)
+        ckpt = CheckPoint.from_checkpoint(self.checkpoint_dir, guid, load_objects=False)
         obj_list = []
         while not objs.empty():
             obj_list.append(objs.get())
         ckpt.save_checkpoint(obj_list)
-        self.logger.debug(f'Saved objects with keys: {[obj["key"] for obj in obj_list]}')
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('Saved objects with keys: %s', [obj['key'] for obj in obj_list])
 
     def _apply_swarp(self, galaxy, fits_files, cleanup=True):
         """Apply the swarp tool for this galaxy and return a preprocessed matrix"""
         center = self._hmsdms_string(galaxy['ra'], galaxy['dec'])
         data_mat = None
-        self.logger.debug('The galaxy is centered at {0},{1}'.format(*center))
+        self.logger.debug('The galaxy is centered at %s,%s', *center)
         for i, fits_file in enumerate(fits_files):
             ret = PreProcess.run_swarp_subprocess(
                 fits_file=fits_file,
@@ -472,6 +499,10 @@ class PreProcess:
               default=10,
               type=int,
               help='The number of processes to use (uses multiprocessing.Pool)')
+@click.option('--checkpoint-dtype',
+              default=None,
+              type=click.Choice(['float16', 'float32', 'float64']),
+              help='The dtype to save the preprocessed images in the checkpoint as (default: unchanged)')
 def main(**kwargs):
     cs = PreProcess(**kwargs)
     cs.run()
@@ -1,9 +1,15 @@
-from hashlib import sha1
+from hashlib import sha256
+
+import numpy as np
 
 
 def get_guid(rows, col_name='specObjID'):
-    """Return a guid for given objects by calculating SHA1 hashing"""
-    str_cols = ''
-    for idx, row in rows.iterrows():
-        str_cols += str(row[col_name])
-    return sha1(str_cols.encode('utf-8')).hexdigest()
+    """Return a guid for given objects by calculating SHA256 hashing
+
+    Integer columns (e.g. specObjID) are hashed from their raw bytes, other
+    columns from their fixed width unicode representation.
+    """
+    values = rows[col_name].to_numpy()
+    if values.dtype.kind not in 'iu':
+        values = values.astype('U')
+    return sha256(np.ascontiguousarray(values).tobytes()).hexdigest()
@@ -1,25 +1,58 @@
+import logging
+import multiprocessing as mp
 import os
+import pickle
 import random
 import unittest
 from datetime import datetime
+from unittest import mock
 
 import numpy as np
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from preprocessing.sdss import checkpoint_objects
 from preprocessing.sdss.checkpoint_objects import CheckPoint, RedShiftCheckPointObject
 
 
+def _object_kwargs(keys, shape=(64, 64, 5)):
+    """Return kwargs for a `RedShiftCheckPointObject` with a random array for each of `keys`"""
+    return [{
+        'key': key,
+        'np_array': np.random.rand(*shape),
+        'redshift': random.random(),
+        'galaxy_meta': {'name': 'this is my name'},
+        'image': 'path/to/image',
+        'timestamp': datetime.now()
+    } for key in keys]
+
+
+def _save_concurrently(worker):
+    """Save objects from a pool worker, restoring the checkpoint before every save"""
+    for i in range(20):
+        ckpt_object = CheckPoint.from_checkpoint(os.getcwd(), 'ckptConcurrent', load_objects=False)
+        ckpt_object.save_checkpoint(_object_kwargs([f'{worker}-{i}-{j}' for j in range(5)], shape=(4, 4)))
+
+
+class PicklesInCreatorOnly:
+    """An object that fails to pickle outside of the process that created it"""
+    def __init__(self):
+        self.pid = os.getpid()
+
+    def __getstate__(self):
+        if os.getpid() != self.pid:
+            raise pickle.PicklingError('Can not pickle in another process')
+        return self.__dict__
+
+
 class TestCheckpoint(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
         cls.ckpt_object = CheckPoint(os.getcwd(), RedShiftCheckPointObject, guid='ckptObject')
-        kwargs = [{
-            'key': i,
-            'np_array': np.random.rand(64, 64, 5),
-            'redshift': random.random(),
-            'galaxy_meta': {'name': 'this is my name'},
-            'image': 'path/to/image',
-            'timestamp': datetime.now()
-        } for i in range(5)]
+        kwargs = _object_kwargs(range(5))
         TestCheckpoint.ckpt_object.save_checkpoint(kwargs, overwrite=True)
 
     def test_meta_objects(self):
@@ -40,17 +73,15 @@ class TestCheckpoint(unittest.TestCase):
         assert 3 in restored
         assert 4 in restored
 
+    def test_empty_key_not_saved(self):
+        restored = CheckPoint.get_object_set(os.getcwd(), 'ckptObject')
+        assert '' not in restored
+        assert None not in restored
+
     def test_add_objects(self):
         restored = CheckPoint.from_checkpoint(os.getcwd(), 'ckptObject')
         assert len(restored.meta_objects) == 5
-        kwargs = [{
-            'key': i,
-            'np_array': np.random.rand(64, 64, 5),
-            'redshift': random.random(),
-            'galaxy_meta': {'name': 'this is my name'},
-            'image': 'path/to/image',
-            'timestamp': datetime.now()
-        } for i in range(4, 10)]
+        kwargs = _object_kwargs(range(4, 10))
         TestCheckpoint.ckpt_object.save_checkpoint(kwargs, 'ckptObject')
         restored_set = CheckPoint.get_object_set(os.getcwd(), 'ckptObject')
         assert len(restored_set) == 10
@@ -60,6 +91,158 @@ class TestCheckpoint(unittest.TestCase):
         assert [isinstance(meta_obj, restored.metaclass) for meta_obj in restored.meta_objects.values()] \
             == [True] * len(restored.meta_objects)
 
+    def test_restore_without_arrays(self):
+        restored = CheckPoint.from_checkpoint(os.getcwd(), 'ckptObject', load_arrays=False)
+        for key, meta_object in restored.meta_objects.items():
+            assert meta_object.np_array is None
+            assert os.path.exists(os.path.join(os.getcwd(), restored.object_files[key] + '.npy'))
+
+    def test_get_object(self):
+        restored = CheckPoint.from_checkpoint(os.getcwd(), 'ckptObject', load_objects=False)
+        assert len(restored.meta_objects) == 0
+        meta_object = restored.get_object(3)
+        assert meta_object.key == 3
+        assert isinstance(meta_object.np_array, np.ndarray)
+        assert list(restored.meta_objects.keys()) == [3]
+
+    def test_get_objects(self):
+        restored = CheckPoint.from_checkpoint(os.getcwd(), 'ckptObject', load_objects=False)
+        meta_objects = restored.get_objects([1, 3])
+        assert sorted(meta_objects.keys()) == [1, 3]
+        assert all(isinstance(obj.np_array, np.ndarray) for obj in meta_objects.values())
+        with self.assertRaises(KeyError):
+            restored.get_objects(['not a key'])
+
+    def test_restore_memory_mapped(self):
+        restored = CheckPoint.from_checkpoint(os.getcwd(), 'ckptObject', load_objects=False)
+        meta_object = restored.get_object(3, mmap_mode='r')
+        assert isinstance(meta_object.np_array.base, np.memmap)
+        assert not meta_object.np_array.flags.writeable
+
+    def test_flush(self):
+        ckpt_object = CheckPoint(os.getcwd(), RedShiftCheckPointObject, guid='ckptFlush')
+        ckpt_object.save_checkpoint(_object_kwargs(range(3)))
+        filename = os.path.join(os.getcwd(), ckpt_object.object_files[0])
+        assert sorted(ckpt_object._unsynced_files) == [filename + '.npy', filename + '.pkl']
+        ckpt_object.flush()
+        assert ckpt_object._unsynced_files == []
+        synced_object = CheckPoint(os.getcwd(), RedShiftCheckPointObject, guid='ckptFlush', fsync_on_save=True)
+        synced_object.save_checkpoint(_object_kwargs(range(3, 6)))
+        assert synced_object._unsynced_files == []
+        CheckPoint.remove_ckpt(os.getcwd(), 'ckptFlush')
+
+    def test_sharded_save(self):
+        ckpt_object = CheckPoint(os.getcwd(), RedShiftCheckPointObject, guid='ckptSharded', num_shards=2)
+        kwargs = _object_kwargs(range(150), shape=(8, 8, 5))
+        ckpt_object.save_checkpoint(kwargs)
+        restored = CheckPoint.from_checkpoint(os.getcwd(), 'ckptSharded')
+        assert len(set(restored.object_files.values())) == 2
+        for obj_kwargs in kwargs:
+            assert np.array_equal(restored.meta_objects[obj_kwargs['key']].np_array, obj_kwargs['np_array'])
+        CheckPoint.remove_ckpt(os.getcwd(), 'ckptSharded')
+
+    @unittest.skipIf('fork' not in mp.get_all_start_methods(), 'requires the fork start method')
+    def test_concurrent_saves(self):
+        CheckPoint(os.getcwd(), RedShiftCheckPointObject, guid='ckptConcurrent').save_checkpoint()
+        # Compact the log on every save, while other workers append to and read it
+        with mock.patch.object(checkpoint_objects, 'LOG_COMPACTION_RATIO', 1), \
+                mp.get_context('fork').Pool(8) as pool:
+            pool.map(_save_concurrently, range(8))
+        restored = CheckPoint.from_checkpoint(os.getcwd(), 'ckptConcurrent')
+        assert len(restored.meta_objects) == 8 * 20 * 5
+        assert set(CheckPoint.get_object_set(os.getcwd(), 'ckptConcurrent')) == set(restored.meta_objects)
+        CheckPoint.remove_ckpt(os.getcwd(), 'ckptConcurrent')
+
+    def test_background_writer(self):
+        ckpt_object = CheckPoint(os.getcwd(), RedShiftCheckPointObject, guid='ckptWriter', background_writer=True)
+        kwargs = _object_kwargs(range(3))
+        ckpt_object.save_checkpoint(kwargs)
+        ckpt_object.close()
+        assert CheckPoint.get_object_set(os.getcwd(), 'ckptWriter') == {0, 1, 2}
+        restored = CheckPoint.from_checkpoint(os.getcwd(), 'ckptWriter')
+        assert np.array_equal(restored.meta_objects[1].np_array, kwargs[1]['np_array'])
+        CheckPoint.remove_ckpt(os.getcwd(), 'ckptWriter')
+
+    def test_background_writer_error(self):
+        ckpt_object = CheckPoint(os.getcwd(), RedShiftCheckPointObject, guid='ckptWriterError', background_writer=True)
+        ckpt_object.save_checkpoint([dict(obj_kwargs, galaxy_meta={'name': PicklesInCreatorOnly()})
+                                     for obj_kwargs in _object_kwargs([0])])
+        with self.assertRaises(RuntimeError):
+            ckpt_object.close()
+        assert 0 not in ckpt_object.object_files
+        assert 0 not in CheckPoint.get_object_set(os.getcwd(), 'ckptWriterError')
+        CheckPoint.remove_ckpt(os.getcwd(), 'ckptWriterError')
+
+    def test_unchanged_objects_skipped(self):
+        restored = CheckPoint.from_checkpoint(os.getcwd(), 'ckptObject', load_objects=False)
+        meta_object = restored.get_object(2)
+        object_files = dict(restored.object_files)
+        restored.save_checkpoint([dict(vars(meta_object), np_array=meta_object.np_array.copy())])
+        assert restored.object_files == object_files
+
+    def test_changed_fields_saved(self):
+        restored = CheckPoint.from_checkpoint(os.getcwd(), 'ckptObject', load_objects=False)
+        meta_object = restored.get_object(2)
+        restored.save_checkpoint([dict(vars(meta_object), np_array=meta_object.np_array.copy(), redshift=0.9)])
+        restored = CheckPoint.from_checkpoint(os.getcwd(), 'ckptObject', load_objects=False)
+        assert restored.get_object(2).redshift == 0.9
+
+    def test_array_dtype(self):
+        ckpt_object = CheckPoint(os.getcwd(), RedShiftCheckPointObject, guid='ckptFloat16', array_dtype='float16')
+        ckpt_object.save_checkpoint(_object_kwargs([0]))
+        restored = CheckPoint.from_checkpoint(os.getcwd(), 'ckptFloat16')
+        assert restored.meta_objects[0].np_array.dtype == np.float16
+        CheckPoint.remove_ckpt(os.getcwd(), 'ckptFloat16')
+
+    @unittest.skipIf(zstandard is None, 'zstd compression requires the zstandard package')
+    def test_zstd_compression(self):
+        ckpt_object = CheckPoint(os.getcwd(), RedShiftCheckPointObject, guid='ckptZstd', compression='zstd')
+        kwargs = _object_kwargs(range(3)) + _object_kwargs([3], shape=(3, 3))
+        # Stacked arrays in a .npy file and mixed shape arrays in a .npz file
+        ckpt_object.save_checkpoint(kwargs[:2])
+        ckpt_object.save_checkpoint(kwargs[2:])
+        files = [os.path.join(os.getcwd(), ckpt_object.object_files[key]) for key in (0, 3)]
+        assert os.path.exists(files[0] + '.npy.zst') and os.path.exists(files[1] + '.npz.zst')
+        restored = CheckPoint.from_checkpoint(os.getcwd(), 'ckptZstd')
+        for obj_kwargs in kwargs:
+            assert np.array_equal(restored.meta_objects[obj_kwargs['key']].np_array, obj_kwargs['np_array'])
+        restored = CheckPoint.from_checkpoint(os.getcwd(), 'ckptZstd', mmap_mode='r')
+        assert np.array_equal(restored.meta_objects[1].np_array, kwargs[1]['np_array'])
+        CheckPoint.remove_ckpt(os.getcwd(), 'ckptZstd')
+        assert not any(filename.startswith('ckptZstd') for filename in os.listdir(os.getcwd()))
+
+    def test_mixed_shape_arrays(self):
+        ckpt_object = CheckPoint(os.getcwd(), RedShiftCheckPointObject, guid='ckptMixed')
+        kwargs = _object_kwargs([7], shape=(2, 2)) + _object_kwargs(['7'], shape=(3, 3))
+        ckpt_object.save_checkpoint(kwargs)
+        restored = CheckPoint.from_checkpoint(os.getcwd(), 'ckptMixed')
+        assert np.array_equal(restored.meta_objects[7].np_array, kwargs[0]['np_array'])
+        assert np.array_equal(restored.meta_objects['7'].np_array, kwargs[1]['np_array'])
+        CheckPoint.remove_ckpt(os.getcwd(), 'ckptMixed')
+
+    def test_migrate_legacy_checkpoint(self):
+        meta_objects = {obj_kwargs['key']: RedShiftCheckPointObject(**obj_kwargs)
+                        for obj_kwargs in _object_kwargs(range(3))}
+        legacy_state = {
+            'created_at': datetime.now(),
+            'checkpoint_dir': os.getcwd(),
+            'metaclass': RedShiftCheckPointObject,
+            'guid': 'ckptLegacy',
+            'logger': logging.getLogger('CheckPoint'),
+            'meta_objects': meta_objects,
+            'meta_keys': set(meta_objects.keys())
+        }
+        # A checkpoint from before the metadata log pickles its objects with the configuration
+        with mock.patch.object(CheckPoint, '__getstate__', lambda self: legacy_state), \
+                open(os.path.join(os.getcwd(), 'ckptLegacy.ckpt'), 'wb') as pklfile:
+            pickle.dump(CheckPoint.__new__(CheckPoint), pklfile)
+        assert set(CheckPoint.get_object_set(os.getcwd(), 'ckptLegacy')) == {0, 1, 2}
+        restored = CheckPoint.from_checkpoint(os.getcwd(), 'ckptLegacy', load_objects=False)
+        assert np.array_equal(restored.get_object(1).np_array, meta_objects[1].np_array)
+        restored.save_checkpoint(_object_kwargs([3]))
+        assert set(CheckPoint.get_object_set(os.getcwd(), 'ckptLegacy')) == {0, 1, 2, 3}
+        CheckPoint.remove_ckpt(os.getcwd(), 'ckptLegacy')
+
     @classmethod
     def tearDownClass(cls):
         CheckPoint.remove_ckpt(os.getcwd(), 'ckptObject')
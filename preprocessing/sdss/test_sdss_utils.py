@@ -0,0 +1,25 @@
+import unittest
+
+import pandas as pd
+
+from preprocessing.sdss.sdss_utils import get_guid
+
+
+class TestGetGuid(unittest.TestCase):
+    def test_integer_column(self):
+        rows = pd.DataFrame({'specObjID': [1237645879578460255, 1237645879578460271]})
+        guid = get_guid(rows)
+        assert guid == get_guid(rows.copy())
+        rows.loc[1, 'specObjID'] += 1
+        assert guid != get_guid(rows)
+
+    def test_string_column(self):
+        rows = pd.DataFrame({'name': ['galaxy-a', 'galaxy-b']})
+        guid = get_guid(rows, col_name='name')
+        assert guid == get_guid(rows.copy(), col_name='name')
+        rows.loc[1, 'name'] = 'galaxy-c'
+        assert guid != get_guid(rows, col_name='name')
+
+
+if __name__ == '__main__':
+    unittest.main()
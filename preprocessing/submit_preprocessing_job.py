@@ -8,8 +8,8 @@ This script runs the preprocessing pipeline in sciserver-compute
 6. Save the result in sciserver-files.
 """
 import logging
-import tempfile
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 import click
 
@@ -51,14 +51,11 @@ class SciServerJobRunner:
 
     @staticmethod
     def upload_repo(file_service_name, volume_name, path_='Redshift-Resnet.tar'):
-        """Archive this repo and upload it to sciserver-files"""
-        tmp_dir = tempfile.TemporaryDirectory().name
-        archive = zip_dir('',
-                          os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'),
-                          format='tar',
-                          dest_dir=tmp_dir)
-        logger.info('The repo is archived in {}'.format(archive))
+        """Archive this repo and upload it to sciserver-files
 
+        The archive is streamed through a pipe to the upload request as it is written,
+        without a temporary file on disk.
+        """
         file_service_name = file_service_name
         file_service = sf.getFileServiceFromName(file_service_name)
         user_volumes = sf.getUserVolumesInfo(file_service)
@@ -66,10 +63,26 @@ class SciServerJobRunner:
         logger.info('Creating {} if it doesn\'t exist.'.format(volume_path))
 
         sf.createUserVolume(file_service, volume_path, quiet=True)
-        sf.upload(file_service,
-                  path=volume_path + '/' + path_,
-                  localFilePath=archive,
-                  quiet=True)
+        repo_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+        read_fd, write_fd = os.pipe()
+
+        def _archive():
+            with open(write_fd, 'wb') as pipe_out:
+                zip_dir(pipe_out, repo_dir)
+
+        def _upload_body(pipe_in, archived):
+            yield from iter(lambda: pipe_in.read(1 << 20), b'')
+            # Raise an archiving error before the body ends, so the request is aborted
+            # instead of uploading a truncated archive
+            archived.result()
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            archived = executor.submit(_archive)
+            with open(read_fd, 'rb') as pipe_in:
+                sf.upload(file_service,
+                          path=volume_path + '/' + path_,
+                          data=_upload_body(pipe_in, archived),
+                          quiet=True)
         logger.info('Uploaded archived repo to sciserver-files at {}'.format(volume_path + '/' + path_))
 
         return volume_path + '/' + path_
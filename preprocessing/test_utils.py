@@ -0,0 +1,28 @@
+import io
+import os
+import tarfile
+import tempfile
+import unittest
+
+from preprocessing.utils import zip_dir
+
+
+class TestZipDir(unittest.TestCase):
+    def test_zip_dir(self):
+        with tempfile.TemporaryDirectory() as base_dir:
+            for filename in ('run.py', 'sdss/preprocess.py', '.git/HEAD',
+                             '__pycache__/run.pyc', 'sdss/__pycache__/preprocess.pyc'):
+                os.makedirs(os.path.join(base_dir, os.path.dirname(filename)), exist_ok=True)
+                with open(os.path.join(base_dir, filename), 'w') as out_file:
+                    out_file.write(filename)
+            archive = io.BytesIO()
+            zip_dir(archive, base_dir)
+
+        archive.seek(0)
+        with tarfile.open(fileobj=archive) as tar:
+            assert sorted(tar.getnames()) == ['.', './run.py', './sdss', './sdss/preprocess.py']
+            assert tar.extractfile('./sdss/preprocess.py').read() == b'sdss/preprocess.py'
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,14 +1,23 @@
 import os
-import shutil
+import tarfile
 
+EXCLUDED_NAMES = ('.git', '__pycache__')
 
-def zip_dir(base_name, base_dir=None, format='tar', dest_dir=None):
+
+def zip_dir(fileobj, base_dir=None, arcname='.', exclude=EXCLUDED_NAMES):
+    """Write a tar archive of `base_dir` to `fileobj`
+
+    The archive is written as a stream in a single pass, so `fileobj` does not need to be
+    seekable and can be the write end of a pipe. Files and directories named in `exclude`
+    are left out of the archive.
+    """
     if base_dir is None:
         base_dir = os.getcwd()
-    base_path = dest_dir + '/' + base_name
-    print(base_path)
-    archive_name = shutil.make_archive(base_name=base_path,
-                                       root_dir=base_dir,
-                                       format=format,
-                                       dry_run=False)
-    return archive_name
\ No newline at end of file
+
+    def _filter(tarinfo):
+        if os.path.basename(tarinfo.name) in exclude:
+            return None
+        return tarinfo
+
+    with tarfile.open(fileobj=fileobj, mode='w|') as tar:
+        tar.add(base_dir, arcname=arcname, recursive=True, filter=_filter)